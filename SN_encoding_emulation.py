@@ -1,153 +1,260 @@
 # emulate_compression.py
 
 import argparse
+import atexit
 import json
+import logging
+import os
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import chain, islice
 from pathlib import Path
+from typing import Optional
 import video_utils as utils  # Assumes video_utils.py from the previous answer
 from tqdm import tqdm
 
-def get_closest_resolution(current_res: str, known_resolutions: list) -> str:
+try:
+    from scipy.spatial import cKDTree  # Optional, for 2-D resolution matching
+except ImportError:
+    cKDTree = None
+
+logger = logging.getLogger(__name__)
+
+def iter_mp4s(root: str, exclude: Optional[str] = None):
+    """
+    Yields every .mp4 file under `root` as it is found, walking the tree
+    with os.scandir instead of listing it all up front. The `exclude`
+    directory (e.g. an output dir nested in the input dir) is not entered.
+    """
+    excluded = Path(exclude).resolve() if exclude else None
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if excluded is None or Path(entry.path).resolve() != excluded:
+                        stack.append(entry.path)
+                elif entry.name.endswith('.mp4') and entry.is_file():
+                    yield Path(entry.path)
+
+def build_resolution_index(resolutions) -> tuple:
     """
-    Finds the closest resolution from a list based on total pixel area.
+    Parses "WxH" strings once into a sorted list, a matching array of
+    pixel areas and, when scipy is available, a k-d tree over the
+    (width, height) points, for get_closest_resolution.
+    """
+    known = sorted(set(resolutions))
+    points = np.array(
+        [utils.parse_resolution(r) for r in known],
+        dtype=np.int64
+    ).reshape(-1, 2)
+    areas = points[:, 0] * points[:, 1]
+    tree = cKDTree(points) if cKDTree is not None and known else None
+    return known, areas, tree
+
+def get_closest_resolution(
+    current_res: str,
+    known_resolutions: list,
+    areas: np.ndarray,
+    tree=None
+) -> str:
+    """
+    Finds the closest resolution from a list: the nearest (width, height)
+    point in `tree` when given, otherwise the closest total pixel area.
+    `areas` holds the pixel area of each entry of `known_resolutions`.
     """
     if not known_resolutions:
         return None
         
-    w, h = map(int, current_res.split('x'))
-    current_area = w * h
-    
-    best_match = None
-    min_diff = float('inf')
-    
-    for res_str in known_resolutions:
-        w_known, h_known = map(int, res_str.split('x'))
-        area = w_known * h_known
-        diff = abs(current_area - area)
-        
-        if diff < min_diff:
-            min_diff = diff
-            best_match = res_str
-            
-    return best_match
+    w, h = utils.parse_resolution(current_res)
+    if tree is not None:
+        _, idx = tree.query([w, h], k=1)
+    else:
+        idx = np.abs(areas - w * h).argmin()
+    return known_resolutions[int(idx)]
 
-def get_emulation_params(current_res: str, samples: list, platform: str) -> dict:
+def get_emulation_params(
+    current_res: str,
+    platform: str,
+    resolution_index: tuple,
+    input_to_target: dict,
+    mean_crf_by_target: dict
+) -> dict:
     """
     Implements the Look-Up-Table logic:
     1. Find best matching input resolution.
     2. Determine target output resolution from that match.
     3. Average CRF of ALL samples with that *target* resolution.
+    `resolution_index` is build_resolution_index() over the original resolutions,
+    `input_to_target` maps original_res -> target_res and `mean_crf_by_target` maps
+    target_res -> mean CRF of its samples; all are built once in main.
     """
-    if not samples:
+    if not input_to_target:
         return None
 
-    # Get all unique original resolutions from our samples
-    known_original_resolutions = list(set(s["original_res"] for s in samples))
-    
     # --- 1. Find best matching input resolution ---
     best_input_res = None
-    if current_res in known_original_resolutions:
+    if current_res in input_to_target:
         best_input_res = current_res
     else:
-        best_input_res = get_closest_resolution(current_res, known_original_resolutions)
+        best_input_res = get_closest_resolution(current_res, *resolution_index)
         
     if not best_input_res:
-        print(f"Warning: No matching resolutions found in model for {current_res}.")
+        logger.warning(f"Warning: No matching resolutions found in model for {current_res}.")
         return None
 
     # --- 2. Determine target output resolution ---
-    # Find the first sample matching our best input res to see its target
     # (We assume all samples with the same input_res have the same target_res)
-    selected_target_res = None
+    selected_target_res = input_to_target.get(best_input_res)
     
     # --- MODIFIED LINE: Set profile based on platform ---
     selected_profile = "high" if platform == "Youtube" else "main"
-
-    for s in samples:
-        if s["original_res"] == best_input_res:
-            selected_target_res = s["target_res"]
-            # We no longer get the profile from the sample
-            break
             
     if not selected_target_res:
-        print(f"Warning: Logic error, no target res found for {best_input_res}.")
+        logger.warning(f"Warning: Logic error, no target res found for {best_input_res}.")
         return None
         
     # --- 3. Average CRF of all samples with that target res ---
-    crf_values = []
-    for s in samples:
-        if s["target_res"] == selected_target_res:
-            crf_values.append(s["crf"])
-            
-    if not crf_values:
-        print(f"Warning: No CRF values found for target res {selected_target_res}.")
+    if selected_target_res not in mean_crf_by_target:
+        logger.warning(f"Warning: No CRF values found for target res {selected_target_res}.")
         return None
-
-    mean_crf = int(np.mean(crf_values))
     
     return {
         "target_resolution": selected_target_res,
-        "crf": mean_crf,
+        "crf": mean_crf_by_target[selected_target_res],
         "profile": selected_profile
     }
 
+# ffmpeg encoder -> codec name reported by ffprobe
+ENCODER_CODECS = {"libx264": "h264", "libx265": "hevc"}
+
+def is_passthrough(orig_meta: dict, params: dict, codec: str, max_crf: Optional[int]) -> bool:
+    """
+    True when re-encoding would be a near no-op: the video already has the
+    target resolution, codec, profile and pix_fmt, and the emulated CRF is at
+    or below the "transparent" threshold `max_crf` (None disables passthrough).
+    """
+    return (
+        max_crf is not None
+        and orig_meta["resolution_str"] == params["target_resolution"]
+        and orig_meta["codec"] == ENCODER_CODECS.get(codec, codec)
+        and orig_meta["profile"].lower() == params["profile"]
+        and orig_meta["pix_fmt"] == "yuv420p"
+        and params["crf"] <= max_crf
+    )
+
+def build_lut(samples: list) -> tuple:
+    """
+    Indexes the samples once instead of rescanning them for every video.
+    Returns the (resolution_index, input_to_target, mean_crf_by_target)
+    arguments of get_emulation_params.
+    """
+    # The first sample seen for an input res decides its target res
+    input_to_target = {}
+    for s in samples:
+        input_to_target.setdefault(s["original_res"], s["target_res"])
+    return build_resolution_index(input_to_target), input_to_target, utils.mean_crf_by_target(samples)
+
+def _process_one(video_path: Path, output_path: Path, params: dict, copy: bool, codec: str, preset: str, threads: int) -> Path:
+    """Worker entry point: encodes (or just copies) one video with its emulation params."""
+    if copy:
+        utils.copy_video(video_path, output_path)
+        return output_path
+
+    utils.encode_video(
+        video_path,
+        output_path,
+        params["target_resolution"],
+        params["crf"],
+        codec,
+        params["profile"],
+        "yuv420p", #hardcoded
+        preset=preset,
+        threads=threads
+    )
+    return output_path
+
 def main(args):
     # Load the compression "database"
     try:
         with open(args.model_file, 'r') as f:
             models = json.load(f)
     except FileNotFoundError:
-        print(f"😢 Error: Model file not found at {args.model_file}")
-        print("Please run SN_parameters_emulation.py first.")
+        logger.error(f"😢 Error: Model file not found at {args.model_file}")
+        logger.error("Please run SN_parameters_emulation.py first.")
         return
 
     # Select the samples for the target platform and codec
     try:
         samples = models[args.platform][args.codec]
     except KeyError:
-        print(f"😢 Error: No model data found for platform='{args.platform}' and codec='{args.codec}' in {args.model_file}")
+        logger.error(f"😢 Error: No model data found for platform='{args.platform}' and codec='{args.codec}' in {args.model_file}")
         return
         
     if not samples:
-        print(f"😢 Error: No samples found for {args.platform}/{args.codec}.")
+        logger.error(f"😢 Error: No samples found for {args.platform}/{args.codec}.")
         return
 
-    # Find all videos recursively
-    print(f"Finding videos 📼 in {args.input_dir}...")
-    videos_to_process = list(Path(args.input_dir).rglob("*.mp4"))
-    print(f"Found {len(videos_to_process)} videos 📼. Starting compression 🤖...")
+    atexit.register(utils.save_probe_cache)
+
+    # Index the model once; videos sharing a resolution share their params
+    lut = build_lut(samples)
+    params_by_res = {}
+
+    # Look ahead at most --workers videos: a smaller batch gets fewer
+    # workers, so each encode still has all the cores it can use
+    video_paths = iter_mp4s(args.input_dir, exclude=args.output_dir)
+    first_videos = list(islice(video_paths, args.workers))
+    workers = max(1, len(first_videos))
+    threads = utils.threads_per_worker(workers)
 
-    for video_path in tqdm(videos_to_process, desc="🤖 Compressing videos"):
-        orig_meta = utils.get_video_metadata(video_path)
-        if not orig_meta:
-            print(f"🤔 Could not read metadata for {video_path}, skipping.")
-            continue
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=utils.init_worker_logging, initargs=(logging.getLogger().level,)
+    ) as executor:
+        # Find all videos recursively, handing each one to the pool as soon as
+        # it's found; probing and param lookup stay here (cheap)
+        logger.info(f"Finding videos 📼 in {args.input_dir} and starting compression 🤖...")
+        futures = []
+        for video_path in chain(first_videos, video_paths):
+            orig_meta = utils.get_video_metadata(video_path)
+            if not orig_meta:
+                logger.warning(f"🤔 Could not read metadata for {video_path}, skipping.")
+                continue
+                
+            orig_res_str = orig_meta['resolution_str']
             
-        orig_res_str = orig_meta['resolution_str']
-        
-        # --- Apply the new LUT logic ---
-        # --- MODIFIED LINE: Pass args.platform to the function ---
-        params = get_emulation_params(orig_res_str, samples, args.platform)
-        
-        if not params:
-            print(f"🤔 Warning: No compression rule found for {video_path.name} ({orig_res_str}). Skipping.")
-            continue
+            # --- Apply the new LUT logic ---
+            # --- MODIFIED LINE: Pass args.platform to the function ---
+            if orig_res_str not in params_by_res:
+                params_by_res[orig_res_str] = get_emulation_params(orig_res_str, args.platform, *lut)
+            params = params_by_res[orig_res_str]
             
-        # Prepare output path, preserving directory structure
-        relative_path = video_path.relative_to(args.input_dir)
-        output_path = Path(args.output_dir) / relative_path
-        # Run compression
-        utils.encode_video(
-            video_path,
-            output_path,
-            params["target_resolution"],
-            params["crf"],
-            args.codec, # Use codec from args
-            params["profile"],
-            "yuv420p" #hardcoded
-        )
-
-    print("\n🐝 Compression emulation complete. 🐝")
+            if not params:
+                logger.warning(f"🤔 Warning: No compression rule found for {video_path.name} ({orig_res_str}). Skipping.")
+                continue
+                
+            # Prepare output path, preserving directory structure
+            relative_path = video_path.relative_to(args.input_dir)
+            output_path = Path(args.output_dir) / relative_path
+            copy = is_passthrough(orig_meta, params, args.codec, args.passthrough_crf)
+
+            # Run compression
+            futures.append(executor.submit(
+                _process_one,
+                video_path,
+                output_path,
+                params,
+                copy,
+                args.codec, # Use codec from args
+                args.preset,
+                threads
+            ))
+
+        logger.info(f"Found {len(futures)} videos 📼 to compress.")
+        for future in tqdm(as_completed(futures), total=len(futures), desc="🤖 Compressing videos", disable=args.quiet):
+            future.result()  # Re-raise anything that went wrong in a worker
+
+    logger.info("\n🐝 Compression emulation complete. 🐝")
 
 
 if __name__ == "__main__":
@@ -157,6 +264,14 @@ if __name__ == "__main__":
     parser.add_argument("--platform", type=str, required=True, choices=['Youtube', 'Facebook', 'other'], help="Target social platform.")
     parser.add_argument("--codec", type=str, default="libx264", help="Target codec (must match model).")
     parser.add_argument("--model-file", type=str, default="compression_models.json", help="Path to the compression model JSON file.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of videos compressed in parallel.")
+    parser.add_argument("--preset", type=str, default="medium", help="x264 preset for the emulated encodes.")
+    parser.add_argument("--passthrough-crf", type=int, default=None, help="Copy videos already at the target resolution/codec/profile instead of re-encoding when the emulated CRF is at or below this value. Disabled by default.")
+    
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only report errors and hide the progress bar.")
     
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    logging.basicConfig(level=logging.ERROR if args.quiet else logging.INFO, format="%(message)s")
     main(args)
\ No newline at end of file
@@ -1,24 +1,139 @@
 # analyze_compression.py
 
 import argparse
+import atexit
 import json
+import logging
 import os
 import tempfile
 import numpy as np
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import pandas as pd
 from pathlib import Path
+from typing import List, Optional, Tuple
 from tqdm import tqdm
 from collections import defaultdict
 import video_utils as utils  # Assumes video_utils.py from the previous answer
 
+logger = logging.getLogger(__name__)
+
+# tmpfs used for the CRF search encodes, when the system has one
+RAM_TMP_DIR = "/dev/shm"
+
+def _load_cache(cache_path: Path) -> dict:
+    """Loads the per-(video, encode settings) bitrate cache, if any."""
+    if not cache_path.exists():
+        return {}
+    try:
+        with open(cache_path, 'r') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning(f"🤔 Ignoring unreadable CRF cache {cache_path}: {e}")
+        return {}
+
+def _save_cache(cache: dict, cache_path: Path):
+    """Writes the bitrate cache back to disk."""
+    with open(cache_path, 'w') as f:
+        json.dump(cache, f, indent=4)
+
+def _sample_windows(duration: float, count: int, length: float) -> Optional[List[Tuple[float, float]]]:
+    """
+    Spreads `count` snippets of `length` seconds evenly over the video, as
+    (start, duration) pairs. Returns None (encode everything) when sampling
+    is disabled or the snippets would cover the whole video anyway.
+    """
+    if count <= 0 or length <= 0 or not duration or count * length >= duration:
+        return None
+    step = duration / (count + 1)
+    return [
+        (round(min(max(step * (i + 1) - length / 2, 0), duration - length), 3), length)
+        for i in range(count)
+    ]
+
+def _cache_key(original_video: Path, target_meta: dict, preset: str, threads: int, backend: str, sample_windows: list = None) -> str:
+    """
+    Identifies a source video + encode settings in the bitrate cache.
+    The source's size and mtime are part of it, so a replaced file at the
+    same path doesn't reuse stale bitrates, and so are the x264 thread
+    count and the trial `backend` ("pyav" or "ffmpeg"), which both
+    slightly change the encoded size.
+    """
+    stat = original_video.stat()
+    return "|".join([
+        str(original_video.resolve()),
+        str(stat.st_size),
+        str(stat.st_mtime_ns),
+        target_meta["resolution_str"],
+        target_meta.get("codec", "libx264"),
+        target_meta.get("profile", "Main"),
+        target_meta.get("pix_fmt", "yuv420p"),
+        preset,
+        str(threads),
+        backend,
+        ",".join(f"{start}+{length}" for start, length in sample_windows) if sample_windows else "full",
+    ])
+
+def _ffmpeg_trial_bitrate(
+    original_video: Path,
+    temp_video_path: Path,
+    target_res: str,
+    crf: int,
+    codec: str,
+    profile: str,
+    pix_fmt: str,
+    preset: str,
+    threads: int,
+    sample_windows: Optional[list],
+    duration: float
+) -> Optional[int]:
+    """
+    Encodes a trial with the ffmpeg CLI and returns its bitrate from the
+    output size over `duration`, or None if the encode failed.
+    """
+    # Drop the previous probe so a failed encode can't pass as this one
+    temp_video_path.unlink(missing_ok=True)
+    utils.encode_video(
+        original_video, 
+        temp_video_path, 
+        target_res, 
+        crf, 
+        codec, 
+        profile,
+        pix_fmt,
+        preset=preset,
+        threads=threads,
+        audio=False,
+        sample_windows=sample_windows
+    )
+    if not temp_video_path.exists():
+        return None
+    return int(temp_video_path.stat().st_size * 8 / duration)
+
 def find_best_crf(
     original_video: Path, 
     target_meta: dict,
-    crf_range: tuple
+    crf_range: tuple,
+    duration: float,
+    bitrates: dict = None,
+    threads: int = 0,
+    sample_windows: list = None,
+    preset: str = "veryfast",
+    backend: str = "ffmpeg"
 ) -> int:
     """
     Finds the CRF value that best matches the target bitrate 
     by re-encoding the original video.
+    With backend="pyav" trials are encoded in-process (no ffmpeg process
+    per CRF) and any PyAV failure raises a RuntimeError so the caller can
+    fall back; with "ffmpeg" they are encoded with the ffmpeg CLI, taking
+    the bitrate from the output size over `duration` (the original's length).
+    With `sample_windows` only those snippets are encoded and the bitrate
+    is measured over their total length instead. Trials use a fast x264
+    `preset`; the CRF/bitrate relation barely depends on it.
+    `bitrates` maps str(crf) -> encoded bitrate; it is consulted before
+    encoding and filled with every new probe.
     """
     target_bitrate = target_meta["bitrate"]
     target_res = target_meta["resolution_str"]
@@ -28,39 +143,115 @@ def find_best_crf(
     
 
     if target_bitrate == 0:
-        print(f"Skipping {original_video.name}, target bitrate is 0.")
+        logger.warning(f"Skipping {original_video.name}, target bitrate is 0.")
         return None
 
-    # Search for the CRF
-    with tempfile.TemporaryDirectory() as tmpdir:
-        temp_video_path = Path(tmpdir) / "temp.mp4"
-        
-        for crf in range(crf_range[0], crf_range[1] + 1):
-            utils.encode_video(
-                original_video, 
-                temp_video_path, 
-                target_res, 
-                crf, 
-                codec, 
-                profile,
-                pix_fmt
+    if not duration:
+        logger.warning(f"Skipping {original_video.name}, duration is unknown.")
+        return None
+
+    if bitrates is None:
+        bitrates = {}
+    if sample_windows:
+        duration = sum(length for _, length in sample_windows)
+
+    # Bisect the CRF: bitrate decreases monotonically as CRF grows, so we
+    # look for the first CRF whose bitrate is *below* the target.
+    # Invariant: bitrate(lo) >= target, bitrate(hi) < target (or hi is the max).
+    lo, hi = crf_range[0] - 1, crf_range[1]
+
+    with ExitStack() as stack:
+        if backend == "pyav":
+            # Encode in-process with PyAV, sharing one demuxer across trials
+            try:
+                container = stack.enter_context(utils.av.open(str(original_video)))
+            except Exception as e:
+                raise RuntimeError(f"PyAV could not open {original_video.name}: {e}") from e
+            measure = partial(
+                utils.encode_bitrate, container, target_res,
+                codec=utils.pyav_encoder(codec), profile=profile, pix_fmt=pix_fmt, preset=preset,
+                threads=threads, sample_windows=sample_windows
             )
-            
-            if not temp_video_path.exists():
-                print(f"Failed to encode temp file for CRF {crf}")
-                exit()
-                
-            encoded_meta = utils.get_video_metadata(temp_video_path)
-            
-            if not encoded_meta:
-                print(f"Failed to probe temp file for CRF {crf}")
-                exit()
+        else:
+            # Keep the trial encodes in RAM when they are only a few short snippets
+            tmp_root = RAM_TMP_DIR if sample_windows and os.path.isdir(RAM_TMP_DIR) else None
+            tmpdir = stack.enter_context(tempfile.TemporaryDirectory(dir=tmp_root))
+            measure = partial(
+                _ffmpeg_trial_bitrate, original_video, Path(tmpdir) / "temp.mp4", target_res,
+                codec=codec, profile=profile, pix_fmt=pix_fmt, preset=preset,
+                threads=threads, sample_windows=sample_windows, duration=duration
+            )
+        
+        while hi - lo > 1:
+            crf = (lo + hi) // 2
 
-            if encoded_meta["bitrate"] < target_bitrate:
-                breakpoint()
-                return crf  # Found the first CRF that is *below* the target
+            if str(crf) not in bitrates:
+                bitrate = measure(crf=crf)
+                if bitrate is None:
+                    if backend == "pyav":
+                        raise RuntimeError(f"PyAV failed to encode CRF {crf} of {original_video.name}")
+                    logger.error(f"Failed to encode temp file for CRF {crf}")
+                    exit()
+                bitrates[str(crf)] = bitrate
 
-    return crf_range[1]  # Return max if bitrate was never met
+            if bitrates[str(crf)] < target_bitrate:
+                hi = crf
+            else:
+                lo = crf
+
+    return hi  # First CRF *below* the target, or max if bitrate was never met
+
+def _warm_start_search(search, search_range: tuple, crf_range: tuple) -> Optional[int]:
+    """
+    Runs `search` (find_best_crf minus its crf_range) in `search_range`, a
+    warm-start window inside `crf_range`, and only widens it when the
+    answer lands on one of its edges.
+    """
+    best_crf = search(crf_range=search_range)
+    if best_crf is None:
+        return None
+
+    # Already-probed CRFs are in the bitrates, so widening is cheap
+    lo, hi = search_range
+    if best_crf == lo and lo > crf_range[0]:
+        # Even the window's lowest CRF was below the target: look further down
+        best_crf = search(crf_range=(crf_range[0], lo))
+    elif best_crf == hi and hi < crf_range[1]:
+        # The target may not have been met in the window: look further up
+        best_crf = search(crf_range=(hi, crf_range[1]))
+    return best_crf
+
+def _process_one(
+    original_video: Path,
+    original_meta: dict,
+    target_meta: dict,
+    bitrates: dict,
+    sample_windows: Optional[list],
+    search_range: tuple,
+    crf_range: tuple,
+    threads: int,
+    preset: str
+) -> Tuple[Optional[int], dict]:
+    """
+    Worker entry point: runs the CRF search for one pair and hands back
+    the (updated) bitrates so the parent can merge them into the cache.
+    `bitrates` maps each backend to use ("pyav" when available, and
+    "ffmpeg") to its cached bitrates; if PyAV fails, the search is redone
+    with the ffmpeg CLI.
+    """
+    search = partial(
+        find_best_crf, original_video, target_meta,
+        duration=original_meta["duration"], threads=threads,
+        sample_windows=sample_windows, preset=preset
+    )
+    if "pyav" in bitrates:
+        try:
+            pyav_search = partial(search, bitrates=bitrates["pyav"], backend="pyav")
+            return _warm_start_search(pyav_search, search_range, crf_range), bitrates
+        except RuntimeError as e:
+            logger.warning(f"🤔 {e}, falling back to the ffmpeg CLI.")
+    ffmpeg_search = partial(search, bitrates=bitrates["ffmpeg"], backend="ffmpeg")
+    return _warm_start_search(ffmpeg_search, search_range, crf_range), bitrates
 
 def main(args):
     originals_dir = Path(args.originals_dir)
@@ -81,63 +272,125 @@ def main(args):
     # We load it first to append data, not overwrite
     model_data = defaultdict(lambda: defaultdict(list))
     if os.path.exists(args.output_model_file):
-        print(f"Loading existing model from {args.output_model_file} to append data...")
+        logger.info(f"Loading existing model from {args.output_model_file} to append data...")
         with open(args.output_model_file, 'r') as f:
             model_data.update(json.load(f))
             # Convert loaded lists to defaultdicts for easier appends
             for platform, codecs in model_data.items():
                 model_data[platform] = defaultdict(list, codecs)
 
+    # Bitrates of previous CRF probes live next to the model file, so
+    # re-runs only encode what they haven't seen yet
+    cache_path = Path(args.output_model_file).with_name("crf_cache.json")
+    crf_cache = _load_cache(cache_path)
+    atexit.register(_save_cache, crf_cache, cache_path)
+    atexit.register(utils.save_probe_cache)
+
     # This list will store all the individual sample data
     samples_list = model_data[args.platform][args.codec]
     
-    print(f"Analyzing platform: {args.platform}, codec: {args.codec}")
+    logger.info(f"Analyzing platform: {args.platform}, codec: {args.codec}")
     
     total_pairs_found = 0
     #for algorithm in algorithms:
-    print(f"Checking Videos 📼")
+    logger.info(f"Checking Videos 📼")
 
     # Construct paths based on logic from your crf_computer_analyzer.py
     # Path to social videos
     social_video_dir = socials_dir #/ args.platform / f"val_{args.platform.lower()}_{algorithm}"
     # Path to original videos
     original_video_dir = originals_dir #/ algorithm / "c23/videos"
-    print(original_video_dir, social_video_dir)
+    logger.info("%s %s", original_video_dir, social_video_dir)
     if not social_video_dir.is_dir():
-        print(f"😢  Fail: Social dir not found, skipping: {social_video_dir}")
+        logger.error(f"😢  Fail: Social dir not found, skipping: {social_video_dir}")
         exit()
     if not original_video_dir.is_dir():
-        print(f"😢  Fail: Original dir not found, skipping: {original_video_dir}")
+        logger.error(f"😢  Fail: Original dir not found, skipping: {original_video_dir}")
         exit()
 
     social_videos = list(social_video_dir.glob("*.mp4"))
-    print(f"  Found {len(social_videos)} social videos 📼 in {social_video_dir.name}")
+    logger.info(f"  Found {len(social_videos)} social videos 📼 in {social_video_dir.name}")
     
-    for social_video_path in tqdm(social_videos, desc="Social Videos"):
+    # Probe in this process (cheap, cached) and leave the encodes to the pool
+    pairs = []
+    for social_video_path in social_videos:
         original_video_path = original_video_dir / social_video_path.name
         
         if not original_video_path.exists():
-            print(f"😱   Missing original for {social_video_path.name}, skipping.")
+            logger.warning(f"😱   Missing original for {social_video_path.name}, skipping.")
             continue
             
         orig_meta = utils.get_video_metadata(original_video_path)
         social_meta = utils.get_video_metadata(social_video_path)
 
         if not orig_meta or not social_meta:
-            print(f"🤔  Could not read metadata for {social_video_path.name}, skipping.")
+            logger.warning(f"🤔  Could not read metadata for {social_video_path.name}, skipping.")
             continue
-        best_crf = find_best_crf(original_video_path, social_meta, crf_range)
-        
-        if best_crf is not None:
-            # Add this sample to our list
-            samples_list.append({
-                "original_res": orig_meta["resolution_str"],
-                "target_res": social_meta["resolution_str"],
-                "crf": best_crf,
-                "profile": social_meta.get("profile", "Main"),
-                "source_file": social_video_path.name
-            })
-            total_pairs_found += 1
+        pairs.append((original_video_path, social_video_path, orig_meta, social_meta))
+
+    # No more workers than pairs, so a small batch still gets all the cores
+    workers = max(1, min(args.workers, len(pairs)))
+    threads = utils.threads_per_worker(workers)
+    # The CRF search only encodes a few short snippets of each original
+    windows = [
+        _sample_windows(orig_meta["duration"], args.sample_count, args.sample_length)
+        for _, _, orig_meta, _ in pairs
+    ]
+    # PyAV trials when it has libx264, with the ffmpeg CLI as fallback;
+    # each backend has its own cached bitrates
+    cache_keys = [
+        {
+            backend: _cache_key(orig_path, social_meta, args.search_preset, threads, backend, sample_windows)
+            for backend in (("pyav", "ffmpeg") if utils.pyav_encoder(social_meta.get("codec", "libx264")) else ("ffmpeg",))
+        }
+        for (orig_path, _, _, social_meta), sample_windows in zip(pairs, windows)
+    ]
+
+    # Warm start: search around the mean CRF already known for the same
+    # target resolution instead of the whole range
+    mean_crf_by_target = utils.mean_crf_by_target(samples_list)
+    search_ranges = []
+    for _, _, _, social_meta in pairs:
+        seed = mean_crf_by_target.get(social_meta["resolution_str"])
+        if seed is None or args.warm_start_radius <= 0:
+            search_ranges.append(crf_range)
+        else:
+            search_ranges.append((
+                min(max(crf_range[0], seed - args.warm_start_radius), crf_range[1]),
+                max(min(crf_range[1], seed + args.warm_start_radius), crf_range[0])
+            ))
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=utils.init_worker_logging, initargs=(logging.getLogger().level,)
+    ) as executor:
+        results = executor.map(
+            partial(_process_one, crf_range=crf_range, threads=threads, preset=args.search_preset),
+            [orig_path for orig_path, _, _, _ in pairs],
+            [orig_meta for _, _, orig_meta, _ in pairs],
+            [social_meta for _, _, _, social_meta in pairs],
+            [{backend: crf_cache.get(key, {}) for backend, key in keys.items()} for keys in cache_keys],
+            windows,
+            search_ranges,
+            chunksize=1
+        )
+
+        for (_, social_video_path, orig_meta, social_meta), keys, (best_crf, bitrates) in tqdm(
+            zip(pairs, cache_keys, results), total=len(pairs), desc="Social Videos", disable=args.quiet
+        ):
+            for backend, key in keys.items():
+                if bitrates[backend]:
+                    crf_cache[key] = bitrates[backend]
+
+            if best_crf is not None:
+                # Add this sample to our list
+                samples_list.append({
+                    "original_res": orig_meta["resolution_str"],
+                    "target_res": social_meta["resolution_str"],
+                    "crf": best_crf,
+                    "profile": social_meta.get("profile", "Main"),
+                    "source_file": social_video_path.name
+                })
+                total_pairs_found += 1
 
     # Update the main data structure
     model_data[args.platform][args.codec] = samples_list
@@ -146,9 +399,9 @@ def main(args):
     with open(args.output_model_file, 'w') as f:
         json.dump(model_data, f, indent=4)
         
-    print(f"🐝 \nSuccessfully added {total_pairs_found} new samples. 🐝")
-    print(f"🐝 Total samples for {args.platform}/{args.codec}: {len(samples_list)} 🐝")
-    print(f"🐝 Compression model saved to {args.output_model_file} 🐝")
+    logger.info(f"🐝 \nSuccessfully added {total_pairs_found} new samples. 🐝")
+    logger.info(f"🐝 Total samples for {args.platform}/{args.codec}: {len(samples_list)} 🐝")
+    logger.info(f"🐝 Compression model saved to {args.output_model_file} 🐝")
 
 
 if __name__ == "__main__":
@@ -160,6 +413,16 @@ if __name__ == "__main__":
     parser.add_argument("--output-model-file", type=str, default="compression_models.json", help="Path to save the output JSON model.")
     parser.add_argument("--crf-min", type=int, default=20, help="Minimum CRF to search.")
     parser.add_argument("--crf-max", type=int, default=51, help="Maximum CRF to search.")
+    parser.add_argument("--sample-count", type=int, default=3, help="Snippets encoded per CRF probe (0 encodes the whole video).")
+    parser.add_argument("--sample-length", type=float, default=5.0, help="Length in seconds of each probed snippet.")
+    parser.add_argument("--search-preset", type=str, default="veryfast", help="x264 preset used for the CRF search encodes.")
+    parser.add_argument("--warm-start-radius", type=int, default=3, help="Search CRFs within this distance of the mean CRF already known for the same target resolution first (0 disables).")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of videos analyzed in parallel.")
+    
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only report errors and hide the progress bar.")
     
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    logging.basicConfig(level=logging.ERROR if args.quiet else logging.INFO, format="%(message)s")
     main(args)
\ No newline at end of file
@@ -1,30 +1,392 @@
 # video_utils.py
 
+import functools
+import os
+import struct
 import subprocess
-import ffmpeg  # Requires ffmpeg-python
 import json
+from fractions import Fraction
+from itertools import groupby
+from operator import itemgetter
+import logging
+import numpy as np
 from pathlib import Path
-from typing import Tuple, Optional
+from typing import List, Tuple, Optional
+
+try:
+    import av  # Optional (PyAV), lets the CRF search encode without spawning ffmpeg
+except ImportError:
+    av = None
+
+logger = logging.getLogger(__name__)
+
+# ffprobe results persisted across runs, keyed by (path, size, mtime)
+PROBE_CACHE_FILE = Path("ffprobe_cache.json")
+
+def _load_probe_cache(cache_path: Path) -> dict:
+    """Loads previously saved ffprobe results, if any."""
+    if not cache_path.exists():
+        return {}
+    try:
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning(f"🤔 Ignoring unreadable ffprobe cache {cache_path}: {e}")
+        return {}
+    # Entries written before "duration" was recorded are probed again
+    return {key: meta for key, meta in cache.items() if "duration" in meta}
+
+# Loaded on first use, so importing this module (e.g. in pool workers)
+# never touches the cache file
+_probe_cache = None
+
+def _get_probe_cache() -> dict:
+    """Returns the ffprobe cache, loading it from disk the first time."""
+    global _probe_cache
+    if _probe_cache is None:
+        _probe_cache = _load_probe_cache(PROBE_CACHE_FILE)
+    return _probe_cache
+
+def save_probe_cache(cache_path: Path = PROBE_CACHE_FILE):
+    """
+    Writes the ffprobe cache back to disk, if anything was probed.
+    Meant to be registered with atexit by the scripts' main.
+    """
+    if _probe_cache:
+        with open(cache_path, 'w') as f:
+            json.dump(_probe_cache, f, indent=4)
+
+# H.264 profile_idc -> profile name, as reported by ffprobe
+_AVC_PROFILES = {
+    66: "Baseline",
+    77: "Main",
+    88: "Extended",
+    100: "High",
+    110: "High 10",
+    122: "High 4:2:2",
+    244: "High 4:4:4 Predictive",
+}
+
+# (chroma_format_idc, bit depth) from the SPS -> pix_fmt
+_AVC_PIX_FMTS = {
+    (0, 8): "gray",
+    (1, 8): "yuv420p",
+    (2, 8): "yuv422p",
+    (3, 8): "yuv444p",
+    (1, 10): "yuv420p10le",
+    (2, 10): "yuv422p10le",
+    (3, 10): "yuv444p10le",
+}
+
+# Full-range 8-bit streams are reported by ffprobe with the JPEG pix_fmts
+_AVC_FULL_RANGE_PIX_FMTS = {
+    "yuv420p": "yuvj420p",
+    "yuv422p": "yuvj422p",
+    "yuv444p": "yuvj444p",
+}
+
+# profile_idc values whose SPS carries chroma format, bit depth and scaling lists
+_AVC_HIGH_PROFILES = {100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135}
+
+def _iter_boxes(f, start: int, end: int):
+    """Yields (type, payload_start, payload_end) for each MP4 box in [start, end)."""
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        size, box_type = struct.unpack(">I4s", f.read(8))
+        header = 8
+        if size == 1:  # 64-bit size follows the type
+            size = struct.unpack(">Q", f.read(8))[0]
+            header = 16
+        elif size == 0:  # box extends to the end of its parent
+            size = end - pos
+        if size < header:
+            return
+        yield box_type.decode('latin-1'), pos + header, pos + size
+        pos += size
+
+def _find_box(f, start: int, end: int, box_type: str) -> Optional[Tuple[int, int]]:
+    """Returns the payload range of the first `box_type` box in [start, end)."""
+    for found_type, payload_start, payload_end in _iter_boxes(f, start, end):
+        if found_type == box_type:
+            return payload_start, payload_end
+    return None
+
+def _read_timescale_duration(f, start: int) -> Tuple[int, int]:
+    """Reads (timescale, duration) from an mvhd/mdhd payload."""
+    f.seek(start)
+    version = f.read(1)[0]
+    if version == 1:
+        f.seek(start + 20)
+        return struct.unpack(">IQ", f.read(12))
+    f.seek(start + 12)
+    return struct.unpack(">II", f.read(8))
+
+class _BitReader:
+    """Reads big-endian bits and Exp-Golomb codes from an H.264 RBSP."""
+
+    def __init__(self, data: bytes):
+        # Drop the emulation prevention bytes (00 00 03 -> 00 00)
+        self.data = data.replace(b"\x00\x00\x03", b"\x00\x00")
+        self.pos = 0
+
+    def bits(self, n: int) -> int:
+        value = 0
+        for _ in range(n):
+            byte = self.data[self.pos >> 3]  # IndexError on truncated data
+            value = (value << 1) | ((byte >> (7 - (self.pos & 7))) & 1)
+            self.pos += 1
+        return value
+
+    def ue(self) -> int:
+        zeros = 0
+        while not self.bits(1):
+            zeros += 1
+            if zeros > 31:
+                raise ValueError("Invalid Exp-Golomb code")
+        return (1 << zeros) - 1 + self.bits(zeros)
+
+    def se(self) -> int:
+        code = self.ue()
+        return (code + 1) // 2 if code & 1 else -(code // 2)
+
+def _parse_sps(sps: bytes) -> Tuple[int, int, bool]:
+    """Returns (chroma_format_idc, luma bit depth, full range) from an SPS NAL unit."""
+    r = _BitReader(sps[1:])  # Skip the NAL header
+    profile_idc = r.bits(8)
+    r.bits(16)  # constraint flags, level_idc
+    r.ue()  # seq_parameter_set_id
+    chroma_format, bit_depth = 1, 8
+    if profile_idc in _AVC_HIGH_PROFILES:
+        chroma_format = r.ue()
+        if chroma_format == 3:
+            r.bits(1)  # separate_colour_plane_flag
+        bit_depth = r.ue() + 8
+        r.ue()  # bit_depth_chroma_minus8
+        r.bits(1)  # qpprime_y_zero_transform_bypass_flag
+        if r.bits(1):  # seq_scaling_matrix_present_flag
+            for i in range(8 if chroma_format != 3 else 12):
+                if r.bits(1):
+                    last = next_scale = 8
+                    for _ in range(16 if i < 6 else 64):
+                        if next_scale:
+                            next_scale = (last + r.se()) % 256
+                            last = next_scale or last
+    r.ue()  # log2_max_frame_num_minus4
+    poc_type = r.ue()
+    if poc_type == 0:
+        r.ue()  # log2_max_pic_order_cnt_lsb_minus4
+    elif poc_type == 1:
+        r.bits(1)  # delta_pic_order_always_zero_flag
+        r.se()
+        r.se()
+        for _ in range(r.ue()):
+            r.se()
+    r.ue()  # max_num_ref_frames
+    r.bits(1)  # gaps_in_frame_num_value_allowed_flag
+    r.ue()  # pic_width_in_mbs_minus1
+    r.ue()  # pic_height_in_map_units_minus1
+    if not r.bits(1):  # frame_mbs_only_flag
+        r.bits(1)  # mb_adaptive_frame_field_flag
+    r.bits(1)  # direct_8x8_inference_flag
+    if r.bits(1):  # frame_cropping_flag
+        for _ in range(4):
+            r.ue()
+
+    # Without VUI or video signal type the stream is limited range
+    full_range = False
+    if r.bits(1):  # vui_parameters_present_flag
+        if r.bits(1) and r.bits(8) == 255:  # aspect_ratio_idc == Extended_SAR
+            r.bits(32)
+        if r.bits(1):  # overscan_info_present_flag
+            r.bits(1)
+        if r.bits(1):  # video_signal_type_present_flag
+            r.bits(3)  # video_format
+            full_range = bool(r.bits(1))
+    return chroma_format, bit_depth, full_range
+
+def _parse_avcc(data: bytes) -> Optional[Tuple[str, str]]:
+    """Extracts (profile, pix_fmt) from an avcC payload, or None if unsure."""
+    profile_idc, constraints = data[1], data[2]
+    if profile_idc not in _AVC_PROFILES:
+        return None
+    if profile_idc == 66 and constraints & 0x40:
+        profile = "Constrained Baseline"
+    elif profile_idc in (110, 122, 244) and constraints & 0x10:
+        return None  # Intra variants, leave those to ffprobe
+    else:
+        profile = _AVC_PROFILES[profile_idc]
+
+    if not data[5] & 0x1f:
+        return None
+    sps_len = struct.unpack(">H", data[6:8])[0]
+    try:
+        chroma_format, bit_depth, full_range = _parse_sps(data[8:8 + sps_len])
+    except (IndexError, ValueError):
+        return None  # Truncated or malformed SPS, leave it to ffprobe
+
+    pix_fmt = _AVC_PIX_FMTS.get((chroma_format, bit_depth))
+    if pix_fmt and full_range:
+        pix_fmt = _AVC_FULL_RANGE_PIX_FMTS.get(pix_fmt, pix_fmt)
+    return (profile, pix_fmt) if pix_fmt else None
+
+def _parse_video_trak(f, start: int, end: int) -> Optional[dict]:
+    """Reads the metadata of a video `trak`, or None for other tracks."""
+    mdia = _find_box(f, start, end, 'mdia')
+    if mdia is None:
+        return None
+    hdlr = _find_box(f, *mdia, 'hdlr')
+    if hdlr is None:
+        return None
+    f.seek(hdlr[0] + 8)
+    if f.read(4) != b'vide':
+        return None
+
+    mdhd = _find_box(f, *mdia, 'mdhd')
+    minf = _find_box(f, *mdia, 'minf')
+    stbl = minf and _find_box(f, *minf, 'stbl')
+    if mdhd is None or stbl is None:
+        return None
+    timescale, duration = _read_timescale_duration(f, mdhd[0])
+
+    # First sample description: visual sample entry + its avcC child
+    stsd = _find_box(f, *stbl, 'stsd')
+    if stsd is None:
+        return None
+    entry = next(_iter_boxes(f, stsd[0] + 8, stsd[1]), None)
+    if entry is None or entry[0] not in ('avc1', 'avc3'):
+        return None
+    f.seek(entry[1] + 24)
+    width, height = struct.unpack(">HH", f.read(4))
+    avcc = _find_box(f, entry[1] + 78, entry[2], 'avcC')
+    if avcc is None:
+        return None
+    f.seek(avcc[0])
+    avc_info = _parse_avcc(f.read(avcc[1] - avcc[0]))
+    if avc_info is None:
+        return None
+    profile, pix_fmt = avc_info
+
+    # Stream size = sum of the sample sizes, as ffmpeg's mov demuxer does
+    stsz = _find_box(f, *stbl, 'stsz')
+    if stsz is None:
+        return None
+    f.seek(stsz[0] + 4)
+    sample_size, sample_count = struct.unpack(">II", f.read(8))
+    if sample_size:
+        data_size = sample_size * sample_count
+    else:
+        data_size = sum(struct.unpack(f">{sample_count}I", f.read(4 * sample_count)))
+
+    # Most common sample delta gives the base frame rate
+    stts = _find_box(f, *stbl, 'stts')
+    if stts is None:
+        return None
+    f.seek(stts[0] + 4)
+    entry_count = struct.unpack(">I", f.read(4))[0]
+    deltas = struct.unpack(f">{2 * entry_count}I", f.read(8 * entry_count))
+    if not deltas:
+        return None
+    _, delta = max(zip(deltas[0::2], deltas[1::2]))
+
+    if not (width and height and timescale and duration and data_size and delta):
+        return None  # e.g. fragmented MP4, whose samples live outside moov
+    return {
+        "width": width,
+        "height": height,
+        "resolution_str": f"{width}x{height}",
+        "bitrate": data_size * 8 * timescale // duration,
+        "frame_rate": timescale / delta,
+        "pix_fmt": pix_fmt,
+        "codec": "h264",
+        "profile": profile,
+    }
+
+def _parse_mp4(path_str: str) -> Optional[dict]:
+    """
+    Reads the video stream metadata straight from the MP4 container
+    headers (moov/trak/stsd/avcC) without spawning ffprobe.
+    Returns None whenever the file isn't a plain H.264 MP4 we understand.
+    """
+    try:
+        with open(path_str, 'rb') as f:
+            file_size = f.seek(0, 2)
+            first_box = next(_iter_boxes(f, 0, file_size), None)
+            if first_box is None or first_box[0] != 'ftyp':
+                return None
+            moov = _find_box(f, 0, file_size, 'moov')
+            mvhd = moov and _find_box(f, *moov, 'mvhd')
+            if mvhd is None:
+                return None
+            timescale, duration = _read_timescale_duration(f, mvhd[0])
+            if not timescale:
+                return None
+            for box_type, start, end in _iter_boxes(f, *moov):
+                if box_type == 'trak':
+                    metadata = _parse_video_trak(f, start, end)
+                    if metadata is not None:
+                        metadata["duration"] = duration / timescale
+                        return metadata
+    except (OSError, IndexError, ValueError, struct.error):
+        pass
+    return None
+
+def _probe(path_str: str) -> dict:
+    """Extracts the video stream metadata, falling back to ffprobe."""
+    metadata = _parse_mp4(path_str)
+    if metadata is not None:
+        return metadata
+
+    # Only ask for the first video stream and the fields we use
+    output = subprocess.check_output([
+        "ffprobe", "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries",
+        "stream=width,height,bit_rate,codec_name,pix_fmt,profile,r_frame_rate:format=duration",
+        "-of", "json",
+        path_str,
+    ])
+    probe = json.loads(output)
+    video_stream = probe['streams'][0]
+    # r_frame_rate is a fraction like "30000/1001" (or "0/0" when unknown)
+    num, _, den = video_stream['r_frame_rate'].partition('/')
+    den = float(den or 1)
+    frame_rate = float(num) / den if den else 0.0
+    return {
+        "width": int(video_stream['width']),
+        "height": int(video_stream['height']),
+        "resolution_str": f"{video_stream['width']}x{video_stream['height']}",
+        "bitrate": int(video_stream.get('bit_rate', 0)), # .get() for safety
+        "frame_rate": frame_rate,
+        "pix_fmt": video_stream.get('pix_fmt', 'yuv420p'),
+        "codec": video_stream.get('codec_name', 'h264'),
+        "profile": video_stream.get('profile', 'Main'),
+        "duration": float(probe['format'].get('duration', 0)),
+    }
 
 def get_video_metadata(video_path: Path) -> dict:
-    """Gets all essential video stream metadata using ffprobe."""
+    """
+    Gets all essential video stream metadata using ffprobe.
+    Results are cached on (path, size, mtime), so an edited file is probed again.
+    """
     try:
-        probe = ffmpeg.probe(str(video_path))
-        video_stream = next(s for s in probe['streams'] if s['codec_type'] == 'video')
-        return {
-            "width": int(video_stream['width']),
-            "height": int(video_stream['height']),
-            "resolution_str": f"{video_stream['width']}x{video_stream['height']}",
-            "bitrate": int(video_stream.get('bit_rate', 0)), # .get() for safety
-            "frame_rate": eval(video_stream['r_frame_rate']),
-            "pix_fmt": video_stream.get('pix_fmt', 'yuv420p'),
-            "codec": video_stream.get('codec_name', 'h264'),
-            "profile": video_stream.get('profile', 'Main'),
-        }
+        video_path = Path(video_path).resolve()
+        stat = video_path.stat()
+        key = f"{video_path}|{stat.st_size}|{stat.st_mtime_ns}"
+        probe_cache = _get_probe_cache()
+        if key not in probe_cache:
+            probe_cache[key] = _probe(str(video_path))
+        return dict(probe_cache[key])
     except Exception as e:
-        print(f"😢 Error probing {video_path}: {e}")
+        logger.error(f"😢 Error probing {video_path}: {e}")
         return None
 
+@functools.lru_cache(maxsize=None)
+def parse_resolution(resolution: str) -> Tuple[int, int]:
+    """Parses a "WxH" string into (width, height); cached per string."""
+    w, h = resolution.split('x')
+    return int(w), int(h)
+
 def adjust_resolution(width: int, height: int, factor: float) -> Tuple[int, int]:
     """Adjusts resolution by a factor, ensuring dimensions are even."""
     new_width = round(width / factor)
@@ -36,6 +398,18 @@ def adjust_resolution(width: int, height: int, factor: float) -> Tuple[int, int]
         
     return new_width, new_height
 
+def mean_crf_by_target(samples: list) -> dict:
+    """
+    Maps each target resolution of the model samples to the mean of their
+    CRFs (rounded down). Shared by the CRF search's warm start and the
+    emulation, so both use the same value.
+    """
+    by_target = itemgetter("target_res")
+    return {
+        target: int(np.array([s["crf"] for s in group], dtype=np.int32).mean())
+        for target, group in groupby(sorted(samples, key=by_target), key=by_target)
+    }
+
 def encode_video(
     input_path: Path, 
     output_path: Path, 
@@ -43,28 +417,156 @@ def encode_video(
     crf: int, 
     codec: str, 
     profile: str,
-    pix_fmt: str = 'yuv420p'
+    pix_fmt: str = 'yuv420p',
+    preset: str = 'medium',
+    threads: int = 0,
+    audio: bool = True,
+    sample_windows: Optional[List[Tuple[float, float]]] = None
 ):
     """
-    Compresses a video to the target specifications using ffmpeg-python.
+    Compresses a video to the target specifications by running ffmpeg
+    directly on a prebuilt argv.
+    `preset` is the x264 speed/efficiency trade-off (e.g. veryfast, medium).
+    threads=0 lets ffmpeg pick the thread count; audio=False drops the
+    audio so the output size reflects the video stream only.
+    With sample_windows=[(start, duration), ...] only those snippets are
+    encoded, concatenated into a single video-only output.
     """
     output_path.parent.mkdir(parents=True, exist_ok=True)
-    w, h = map(int, target_resolution.split('x'))
+    w, h = parse_resolution(target_resolution)
     
+    if sample_windows:
+        inputs = []
+        for start, duration in sample_windows:
+            inputs += ["-ss", str(start), "-t", str(duration), "-i", str(input_path)]
+        streams = "".join(f"[{i}:v]" for i in range(len(sample_windows)))
+        video_args = [
+            "-filter_complex",
+            f"{streams}concat=n={len(sample_windows)}:v=1:a=0,scale={w}:{h}[v]",
+            "-map", "[v]",
+        ]
+    else:
+        inputs = ["-i", str(input_path)]
+        video_args = ["-vf", f"scale={w}:{h}"]
+
+    argv = [
+        "ffmpeg", "-nostdin", "-loglevel", "error", "-y",
+        *inputs,
+        *video_args,
+        "-c:v", codec,
+        "-crf", str(crf),
+        "-preset", preset,
+        "-profile:v", profile,
+        "-pix_fmt", pix_fmt,
+        "-threads", str(threads),
+        *([] if audio else ["-an"]),
+        str(output_path),
+    ]
+    result = subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        logger.error(f"😢 FFmpeg error on {input_path}:\n{result.stderr.decode()}")
+
+@functools.lru_cache(maxsize=None)
+def pyav_encoder(codec: str) -> Optional[str]:
+    """
+    Returns the PyAV encoder to use for `codec` (e.g. "h264" -> "libx264"),
+    or None when PyAV is missing or lacks libx264. Only libx264 is accepted,
+    so in-process trials measure the same bitrates as the ffmpeg CLI.
+    """
+    if av is None or codec not in ("h264", "libx264"):
+        return None
+    try:
+        encoder = av.Codec("libx264", "w")
+    except Exception:
+        return None
+    return encoder.name if encoder.name == "libx264" else None
+
+def encode_bitrate(
+    container,
+    target_resolution: str,
+    crf: int,
+    codec: str,
+    profile: str,
+    pix_fmt: str = 'yuv420p',
+    preset: str = 'medium',
+    threads: int = 0,
+    sample_windows: Optional[List[Tuple[float, float]]] = None
+) -> Optional[int]:
+    """
+    Encodes the video stream of an open PyAV input `container` in-process
+    with the same settings as encode_video, and returns the resulting
+    bitrate without writing any file. The container is rewound first, so
+    the same one can be reused for several CRFs.
+    With sample_windows=[(start, duration), ...] only those snippets are
+    encoded, like encode_video does.
+    """
     try:
-        (
-            ffmpeg
-            .input(str(input_path))
-            .filter('scale', w, h)
-            .output(
-                str(output_path),
-                vcodec=codec,
-                crf=crf,
-                **{'profile:v': profile},
-                pix_fmt=pix_fmt,
-                loglevel='error'
-            )
-            .run(overwrite_output=True, capture_stdout=True, capture_stderr=True)
-        )
-    except ffmpeg.Error as e:
-        print(f"😢 FFmpeg error on {input_path}:\n{e.stderr.decode()}")
\ No newline at end of file
+        w, h = parse_resolution(target_resolution)
+        stream = container.streams.video[0]
+        if not stream.codec_context.is_open:
+            stream.thread_type = "AUTO"  # Multi-threaded decoding
+        rate = Fraction(stream.average_rate or stream.guessed_rate or 25)
+        start_time = float(stream.start_time * stream.time_base) if stream.start_time else 0.0
+
+        encoder = av.CodecContext.create(codec, "w")
+        encoder.width = w
+        encoder.height = h
+        encoder.pix_fmt = pix_fmt
+        encoder.framerate = rate
+        encoder.time_base = 1 / rate
+        encoder.thread_count = threads
+        encoder.options = {"crf": str(crf), "preset": preset, "profile": profile}
+
+        total_bytes = 0
+        frame_count = 0
+        for window_start, window_length in sample_windows or [(0.0, None)]:
+            container.seek(int((start_time + window_start) / stream.time_base), stream=stream)
+            for frame in container.decode(stream):
+                if frame.time is None or frame.time - start_time < window_start:
+                    continue  # Seeking lands on the keyframe before the window
+                if window_length is not None and frame.time - start_time >= window_start + window_length:
+                    break
+                # Same scaler as ffmpeg's scale filter; drop the source frame
+                # type so the encoder picks its own keyframes
+                frame = frame.reformat(width=w, height=h, format=pix_fmt, interpolation="BICUBIC")
+                frame.pts = frame_count
+                frame.pict_type = av.video.frame.PictureType.NONE
+                frame_count += 1
+                for packet in encoder.encode(frame):
+                    total_bytes += packet.size
+        for packet in encoder.encode(None):
+            total_bytes += packet.size
+
+        if not frame_count:
+            return None
+        return int(total_bytes * 8 * rate / frame_count)
+    except Exception as e:
+        logger.warning(f"🤔 PyAV error on {container.name}: {e}")
+        return None
+
+def copy_video(input_path: Path, output_path: Path):
+    """Remuxes a video to output_path without re-encoding it."""
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    argv = [
+        "ffmpeg", "-nostdin", "-loglevel", "error", "-y",
+        "-i", str(input_path),
+        "-c", "copy",
+        str(output_path),
+    ]
+    result = subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        logger.error(f"😢 FFmpeg error on {input_path}:\n{result.stderr.decode()}")
+
+def threads_per_worker(workers: int) -> int:
+    """
+    Splits the cores between `workers` parallel encodes instead of letting
+    every ffmpeg grab them all.
+    """
+    return max(1, (os.cpu_count() or 1) // workers)
+
+def init_worker_logging(level: int):
+    """
+    ProcessPoolExecutor initializer: applies the parent's logging setup
+    (incl. -q) in a spawned worker process.
+    """
+    logging.basicConfig(level=level, format="%(message)s")